@@ -11,6 +11,7 @@ from PIL import Image
 import torch
 from diffusers import QwenImageEditPipeline
 import numpy as np
+from memory_monitor import MemoryMonitor
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -69,6 +70,11 @@ except Exception as e:
     # Fallback to a simpler approach if model loading fails
     pipe = None
 
+# Memory telemetry and recycle watchdog (see MEMORY_* in technical.md).
+# Started after model loading so the baseline excludes the model weights.
+memory_monitor = MemoryMonitor.from_env().start()
+memory_monitor.init_app(app)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
@@ -176,7 +182,8 @@ def upload_file():
         output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
         
         # Process the image
-        success = process_image_with_qwen(prompt, file_path, output_path)
+        with memory_monitor.track():
+            success = process_image_with_qwen(prompt, file_path, output_path)
         
         return render_template('result.html',
                              original_image=unique_filename,
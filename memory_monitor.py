@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Memory telemetry for long-running Qwen Image Editor workers
+
+Tracks per-request peak and retained memory (host RSS, torch allocator stats
+when available, and optionally tracemalloc), exposes the top allocation sites
+and recycles the worker once memory passes a configured threshold.
+Works on CPU-only hosts; torch is optional. psutil is needed for current RSS
+on macOS (without it only the lifetime peak is available there).
+"""
+
+import gc
+import os
+import signal
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+MB = 1024 * 1024
+
+# Frames that only show up because of our own bookkeeping
+_IGNORED_TRACE_FILES = (tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>",
+                        "<frozen importlib._bootstrap_external>", "<unknown>")
+
+_LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def _detect_rss_source():
+    if psutil is not None:
+        return 'psutil'
+    if os.path.exists('/proc/self/statm'):
+        return 'proc'
+    if resource is not None:
+        return 'ru_maxrss'
+    return None
+
+
+# 'psutil' and 'proc' report current RSS. 'ru_maxrss' (macOS without psutil) is
+# the lifetime peak, which can only grow, so it is never used for the limit check.
+RSS_SOURCE = _detect_rss_source()
+RSS_IS_CURRENT = RSS_SOURCE in ('psutil', 'proc')
+
+
+def get_rss_bytes():
+    """Return the resident set size of this process in bytes (see RSS_SOURCE)"""
+    if RSS_SOURCE == 'psutil':
+        return psutil.Process().memory_info().rss
+    if RSS_SOURCE == 'proc':
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    if RSS_SOURCE == 'ru_maxrss':
+        # Lifetime peak (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return 0
+
+
+def get_torch_memory_stats():
+    """Return torch allocator stats in bytes, or an empty dict if unavailable"""
+    if torch is None:
+        return {}
+    try:
+        if torch.cuda.is_available():
+            return {
+                'device': 'cuda',
+                'allocated': torch.cuda.memory_allocated(),
+                'reserved': torch.cuda.memory_reserved(),
+                'peak_allocated': torch.cuda.max_memory_allocated(),
+            }
+        if torch.backends.mps.is_available():
+            return {
+                'device': 'mps',
+                'allocated': torch.mps.current_allocated_memory(),
+                'reserved': torch.mps.driver_allocated_memory(),
+            }
+    except Exception as e:
+        print(f"Could not read torch memory stats: {e}")
+    return {}
+
+
+def _reset_torch_peak():
+    if torch is None:
+        return
+    try:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+    except Exception as e:
+        print(f"Could not reset torch peak memory stats: {e}")
+
+
+def count_live_instances(cls):
+    """Count live objects of the given class (walks the GC heap, debug use only)"""
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, cls))
+
+
+class MemoryMonitor:
+    """
+    Per-request memory telemetry with a recycle watchdog
+
+    limit_mb:        RSS threshold that triggers a worker recycle (0 disables)
+    trace_frames:    tracemalloc traceback depth (0 disables tracemalloc)
+    sample_interval: seconds between RSS samples while a request is running
+    gc_collect:      run gc.collect() before measuring retained memory
+    history_size:    number of per-request records kept for /debug/memory
+
+    Peak and retained values for tracemalloc and torch come from process-wide
+    counters, so they are only per-request accurate when tracked blocks do not
+    overlap. Overlapping records are flagged with 'overlapped': True.
+    """
+
+    def __init__(self, limit_mb=0, trace_frames=0, sample_interval=0.1, gc_collect=False,
+                 history_size=100):
+        self.limit_bytes = int(limit_mb * MB)
+        self.trace_frames = trace_frames
+        self.sample_interval = sample_interval
+        self.gc_collect = gc_collect
+        self.history = deque(maxlen=history_size)
+        self.requests_tracked = 0
+        self.recycle_pending = False
+        self._recycling = False
+        self._active_requests = 0
+        self._tracking = []
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._baseline_rss = None
+        self._watchdog = None
+
+    @classmethod
+    def from_env(cls):
+        """Build a monitor from the MEMORY_* environment variables"""
+        return cls(
+            limit_mb=float(os.environ.get('MEMORY_LIMIT_MB', 0)),
+            trace_frames=int(os.environ.get('MEMORY_TRACE_FRAMES', 0)),
+            sample_interval=float(os.environ.get('MEMORY_SAMPLE_INTERVAL', 0.1)),
+            gc_collect=_env_flag('MEMORY_GC_COLLECT'),
+        )
+
+    def start(self, watchdog_interval=5.0):
+        """
+        Record the baseline and launch the watchdog thread
+
+        Call this once the model is loaded, so growth is measured from the
+        steady state rather than from an empty process.
+        """
+        if self.trace_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+        if tracemalloc.is_tracing():
+            self._baseline = tracemalloc.take_snapshot()
+        self._baseline_rss = get_rss_bytes()
+
+        if self.limit_bytes and not RSS_IS_CURRENT:
+            print(f"⚠️  Current RSS is not available (source: {RSS_SOURCE}) - install psutil "
+                  f"to use MEMORY_LIMIT_MB. Memory watchdog disabled")
+            self.limit_bytes = 0
+        elif self.limit_bytes and self._baseline_rss >= self.limit_bytes:
+            # Recycling now would only restart the worker in a loop
+            print(f"⚠️  RSS after startup ({self._baseline_rss / MB:.1f} MB) is already above "
+                  f"MEMORY_LIMIT_MB ({self.limit_bytes / MB:.1f} MB) - memory watchdog disabled")
+            self.limit_bytes = 0
+
+        if self.limit_bytes and self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watchdog_loop, args=(watchdog_interval,),
+                                              name='memory-watchdog', daemon=True)
+            self._watchdog.start()
+        return self
+
+    @property
+    def active_requests(self):
+        return self._active_requests
+
+    def over_limit(self):
+        """Check whether RSS has passed the recycle threshold"""
+        if not self.limit_bytes or not RSS_IS_CURRENT:
+            return False
+        try:
+            return get_rss_bytes() >= self.limit_bytes
+        except Exception as e:
+            print(f"Could not read RSS: {e}")
+            return False
+
+    def request_started(self):
+        """Count a request as in flight; returns False if the worker is shutting down"""
+        with self._lock:
+            self._active_requests += 1
+            return not self._recycling
+
+    def request_finished(self):
+        """Mark a request as done and recycle if it was the last one before the limit"""
+        with self._lock:
+            self._active_requests -= 1
+            recycle = self._claim_recycle()
+        if recycle:
+            self._send_recycle_signal()
+
+    @contextmanager
+    def track(self, label=None):
+        """
+        Record peak and retained memory deltas for the wrapped block
+
+        Telemetry errors are logged and never propagate into the tracked block.
+        """
+        record = None
+        stop = threading.Event()
+        sampler = None
+        try:
+            before = self._measure_before()
+            record = self._open_record(label)
+
+            # Sample RSS in the background; a single before/after pair misses the peak
+            before['rss_peak'] = before['rss']
+
+            def sample():
+                while not stop.wait(self.sample_interval):
+                    try:
+                        before['rss_peak'] = max(before['rss_peak'], get_rss_bytes())
+                    except Exception:
+                        return
+
+            sampler = threading.Thread(target=sample, name='memory-sampler', daemon=True)
+            sampler.start()
+        except Exception as e:
+            print(f"Memory telemetry unavailable for this request: {e}")
+
+        try:
+            yield record
+        finally:
+            stop.set()
+            if sampler is not None:
+                sampler.join()
+            if record is not None:
+                self._close_record(record, before)
+
+    def _measure_before(self):
+        tracing = tracemalloc.is_tracing()
+        before = {
+            'time': time.time(),
+            'tracing': tracing,
+            'rss': get_rss_bytes(),
+            'traced': tracemalloc.get_traced_memory()[0] if tracing else 0,
+        }
+        if tracing:
+            tracemalloc.reset_peak()
+        _reset_torch_peak()
+        before['torch'] = get_torch_memory_stats()
+        return before
+
+    def _open_record(self, label):
+        with self._lock:
+            self.requests_tracked += 1
+            record = {'label': label or f"request-{self.requests_tracked}", 'overlapped': False}
+            if self._tracking:
+                record['overlapped'] = True
+                for other in self._tracking:
+                    other['overlapped'] = True
+            self._tracking.append(record)
+        return record
+
+    def _close_record(self, record, before):
+        try:
+            duration = time.time() - before['time']
+
+            # Without a collection, "retained" also counts unreachable cycles
+            if self.gc_collect:
+                gc.collect()
+            rss_after = get_rss_bytes()
+            rss_peak = max(before['rss_peak'], rss_after)
+            tracing = before['tracing'] and tracemalloc.is_tracing()
+            traced_after, traced_peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+            torch_before = before['torch']
+            torch_after = get_torch_memory_stats()
+
+            record.update({
+                'timestamp': before['time'],
+                'duration_s': round(duration, 3),
+                'rss_source': RSS_SOURCE,
+                'rss_before_mb': round(before['rss'] / MB, 1),
+                'rss_after_mb': round(rss_after / MB, 1),
+                'rss_peak_delta_mb': round((rss_peak - before['rss']) / MB, 1),
+                'rss_retained_mb': round((rss_after - before['rss']) / MB, 1),
+            })
+            if tracing:
+                record['traced_peak_delta_mb'] = round((traced_peak - before['traced']) / MB, 1)
+                record['traced_retained_mb'] = round((traced_after - before['traced']) / MB, 1)
+            if torch_after:
+                record['torch_device'] = torch_after['device']
+                record['torch_retained_mb'] = round(
+                    (torch_after['allocated'] - torch_before.get('allocated', 0)) / MB, 1)
+                if 'peak_allocated' in torch_after:
+                    record['torch_peak_delta_mb'] = round(
+                        (torch_after['peak_allocated'] - torch_before.get('allocated', 0)) / MB, 1)
+
+            over_limit = self.over_limit()
+            print(f"Memory [{record['label']}]: RSS {record['rss_after_mb']} MB "
+                  f"(peak +{record['rss_peak_delta_mb']} MB, retained {record['rss_retained_mb']:+} MB)")
+        except Exception as e:
+            print(f"Could not record memory telemetry for {record['label']}: {e}")
+            over_limit = False
+
+        with self._lock:
+            self._tracking = [r for r in self._tracking if r is not record]
+            self.history.append(record)
+            if over_limit:
+                self.recycle_pending = True
+
+    def init_app(self, app, guarded_endpoints=('upload_file',), debug_endpoint=None):
+        """
+        Register the request hooks (and optionally /debug/memory) on a Flask app
+
+        Every request is counted as in flight from before_request until its
+        response body has been sent, so a recycle never cuts one off. Once a
+        recycle is pending, guarded endpoints get a 503; once it is under way,
+        every request does. debug_endpoint defaults to the MEMORY_DEBUG flag.
+        """
+        from flask import g, request
+
+        @app.before_request
+        def track_request_start():
+            accepting = self.request_started()
+            g.memory_request_open = True
+            if not accepting or (self.recycle_pending and request.endpoint in guarded_endpoints):
+                return 'Server is restarting to free memory, please retry shortly', 503
+
+        @app.after_request
+        def track_request_end(response):
+            # Keep the request counted until its response body has been sent
+            if g.pop('memory_request_open', False):
+                response.call_on_close(self.request_finished)
+            return response
+
+        @app.teardown_request
+        def track_request_teardown(exc):
+            # Requests that never reached after_request (unhandled errors)
+            if g.pop('memory_request_open', False):
+                self.request_finished()
+
+        if debug_endpoint is None:
+            debug_endpoint = _env_flag('MEMORY_DEBUG')
+        if debug_endpoint:
+            app.add_url_rule('/debug/memory', 'debug_memory', self._debug_memory_view)
+
+    def _debug_memory_view(self):
+        """Memory telemetry: RSS, allocator stats, recent requests and top allocation sites"""
+        from flask import abort, jsonify, request
+
+        # Localhost only. access_route includes X-Forwarded-For hops, so a
+        # remote client behind a proxy that appends to it is refused too.
+        if not all(addr in _LOCAL_ADDRESSES for addr in [request.remote_addr] + request.access_route):
+            abort(403)
+        limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+        report = self.report(limit)
+        try:
+            from PIL import Image
+            report['live_pil_images'] = count_live_instances(Image.Image)
+        except ImportError:
+            pass
+        return jsonify(report)
+
+    def top_allocations(self, limit=10, compare_to_baseline=True):
+        """Return the top allocation sites, by default as growth since start()"""
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, name) for name in _IGNORED_TRACE_FILES])
+
+        if compare_to_baseline and self._baseline is not None:
+            stats = snapshot.compare_to(self._baseline, 'lineno')
+            stats.sort(key=lambda s: s.size_diff, reverse=True)
+            return [{
+                'site': str(s.traceback),
+                'size_kb': round(s.size / 1024, 1),
+                'size_diff_kb': round(s.size_diff / 1024, 1),
+                'count': s.count,
+                'count_diff': s.count_diff,
+            } for s in stats[:limit]]
+
+        return [{
+            'site': str(s.traceback),
+            'size_kb': round(s.size / 1024, 1),
+            'count': s.count,
+        } for s in snapshot.statistics('lineno')[:limit]]
+
+    def report(self, limit=10):
+        """Summarise current memory state for the /debug/memory endpoint"""
+        limit = max(1, limit)
+        rss = get_rss_bytes()
+        report = {
+            'rss_source': RSS_SOURCE,
+            'rss_mb': round(rss / MB, 1),
+            'rss_growth_mb': round((rss - (self._baseline_rss or rss)) / MB, 1),
+            'limit_mb': round(self.limit_bytes / MB, 1) if self.limit_bytes else None,
+            'recycle_pending': self.recycle_pending,
+            'active_requests': self._active_requests,
+            'requests_tracked': self.requests_tracked,
+            'tracemalloc': tracemalloc.is_tracing(),
+            'torch': {k: (round(v / MB, 1) if isinstance(v, int) else v)
+                      for k, v in get_torch_memory_stats().items()},
+            'recent_requests': list(self.history)[-limit:],
+            'top_allocations': self.top_allocations(limit),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            report['traced_current_mb'] = round(current / MB, 1)
+            report['traced_peak_mb'] = round(peak / MB, 1)
+        return report
+
+    def _claim_recycle(self):
+        # Caller holds the lock. Deciding and flagging under one lock means no
+        # request can start between the idle check and the signal, and only
+        # one caller ever sends it.
+        if not self.recycle_pending or self._active_requests or self._recycling:
+            return False
+        self._recycling = True
+        return True
+
+    def _send_recycle_signal(self):
+        """Ask the worker to shut down so a supervisor can restart it"""
+        print(f"Memory limit reached (RSS {get_rss_bytes() / MB:.1f} MB >= "
+              f"{self.limit_bytes / MB:.1f} MB) - recycling worker {os.getpid()}")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def _watchdog_loop(self, interval):
+        # Only recycle when idle; with requests in flight, the last one to
+        # finish triggers the recycle through request_finished().
+        while not self._recycling:
+            time.sleep(interval)
+            if not self.over_limit():
+                continue
+            with self._lock:
+                self.recycle_pending = True
+                recycle = self._claim_recycle()
+            if recycle:
+                self._send_recycle_signal()
@@ -24,6 +24,10 @@ def main():
         print("❌ PyTorch not found")
         return 1
     
+    if os.environ.get('MEMORY_LIMIT_MB'):
+        print("\n⚠️  MEMORY_LIMIT_MB is set, but this launcher does not restart the server.")
+        print("   The app will exit when the limit is reached - see README for a gunicorn setup.")
+    
     print("\n📱 Starting web server...")
     print("🌐 Open your browser to: http://localhost:5001")
     print("📁 Upload folder: uploads/")
@@ -53,6 +53,10 @@ def main():
         print("   - Model loading: ~3-5 minutes")
         print("   - Image processing: ~2-5 minutes per image")
     
+    if os.environ.get('MEMORY_LIMIT_MB'):
+        print("\n⚠️  MEMORY_LIMIT_MB is set, but this launcher does not restart the server.")
+        print("   The app will exit when the limit is reached - see README for a gunicorn setup.")
+    
     # Import and start the CUDA-optimized app
     try:
         from app_cuda import app
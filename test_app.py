@@ -88,6 +88,195 @@ def test_directories():
     
     return True
 
+def test_memory_monitor():
+    """Test per-request memory telemetry and the recycle threshold (CPU-only)"""
+    print("\n🔍 Testing memory monitor...")
+
+    from memory_monitor import MemoryMonitor, get_rss_bytes
+
+    monitor = MemoryMonitor(trace_frames=5, sample_interval=0.01, gc_collect=True).start()
+
+    retained = []
+    with monitor.track("leaky-request"):
+        retained.append(bytearray(8 * 1024 * 1024))
+        scratch = [bytearray(1024) for _ in range(1000)]
+        del scratch
+
+    record = monitor.history[-1]
+    if record['label'] != "leaky-request" or record['overlapped'] or record['traced_retained_mb'] < 7:
+        print(f"❌ Retained memory not recorded: {record}")
+        return False
+    print(f"✅ Per-request record: {record}")
+
+    if record['traced_peak_delta_mb'] < record['traced_retained_mb']:
+        print("❌ Peak delta smaller than retained delta")
+        return False
+
+    report = monitor.report()
+    if not report['top_allocations'] or 'test_app.py' not in report['top_allocations'][0]['site']:
+        print(f"❌ Top allocation site not reported: {report['top_allocations'][:1]}")
+        return False
+    print(f"✅ Top allocation site: {report['top_allocations'][0]['site']}")
+
+    # Nested (concurrent) tracking shares process-wide counters and must be flagged
+    with monitor.track("outer"):
+        with monitor.track("inner"):
+            pass
+    if not all(r['overlapped'] for r in list(monitor.history)[-2:]):
+        print("❌ Overlapping requests not flagged")
+        return False
+    print("✅ Overlapping requests flagged")
+
+    # Telemetry errors must not fail the tracked request or leave orphaned records
+    import memory_monitor as mm
+    def broken_reset():
+        raise RuntimeError("allocator unavailable")
+    original_reset, mm._reset_torch_peak = mm._reset_torch_peak, broken_reset
+    try:
+        with monitor.track("broken-telemetry") as record:
+            ran = True
+    finally:
+        mm._reset_torch_peak = original_reset
+    with monitor.track("after-broken") as record:
+        pass
+    if not ran or record['overlapped'] or monitor._tracking:
+        print("❌ Telemetry failure leaked into later requests")
+        return False
+    print("✅ Telemetry failures do not affect the request")
+
+    if monitor.over_limit() or monitor.recycle_pending:
+        print("❌ Recycle triggered without a memory limit")
+        return False
+
+    # A limit below the current RSS must mark the worker for recycling
+    low_limit = MemoryMonitor(limit_mb=get_rss_bytes() / (1024 * 1024) / 2, trace_frames=0)
+    with low_limit.track("over-limit"):
+        pass
+    if not low_limit.recycle_pending:
+        print("❌ Recycle not scheduled above memory limit")
+        return False
+    print("✅ Recycle scheduled above memory limit")
+
+    # In-flight requests hold off the recycle, and the signal is sent only once
+    signals = []
+    low_limit._send_recycle_signal = lambda: signals.append(True)
+    low_limit.request_started()
+    low_limit.request_started()
+    low_limit.request_finished()
+    if signals:
+        print("❌ Recycled while a request was still in flight")
+        return False
+    low_limit.request_finished()
+    if low_limit.request_started():
+        print("❌ New request accepted after recycle")
+        return False
+    low_limit.request_finished()
+    if signals != [True]:
+        print(f"❌ Expected exactly one recycle signal, got {len(signals)}")
+        return False
+    print("✅ Recycle waits for in-flight requests and fires once")
+
+    return True
+
+def test_memory_request_hooks():
+    """Test the Flask in-flight counting, 503s and one-shot recycle (no model needed)"""
+    print("\n🔍 Testing memory request hooks...")
+
+    from flask import Flask
+    from memory_monitor import MemoryMonitor, get_rss_bytes
+
+    # Limit below current RSS; start() is skipped so the watchdog stays off
+    monitor = MemoryMonitor(limit_mb=get_rss_bytes() / (1024 * 1024) / 2)
+    signals = []
+    monitor._send_recycle_signal = lambda: signals.append(True)
+
+    app = Flask(__name__)
+    app.testing = True  # propagate exceptions: after_request is skipped
+    monitor.init_app(app, debug_endpoint=True)
+
+    @app.route('/upload', methods=['POST'])
+    def upload_file():
+        with monitor.track():
+            pass
+        return 'ok'
+
+    @app.route('/boom')
+    def boom():
+        raise RuntimeError("boom")
+
+    client = app.test_client()
+
+    # Unhandled error: only teardown_request runs, the request must still be released
+    try:
+        client.get('/boom')
+    except RuntimeError:
+        pass
+    if monitor.active_requests != 0:
+        print(f"❌ Errored request still counted: {monitor.active_requests}")
+        return False
+    print("✅ Teardown releases requests that skip after_request")
+
+    # The upload goes over the limit; the signal waits until its body is closed
+    response = client.post('/upload', buffered=False)
+    if response.status_code != 200 or not monitor.recycle_pending:
+        print(f"❌ Upload did not schedule a recycle: {response.status_code}")
+        return False
+    if signals or monitor.active_requests != 1:
+        print("❌ Recycled before the response was closed")
+        return False
+    response.close()
+    if signals != [True]:
+        print(f"❌ Expected one recycle signal after close, got {len(signals)}")
+        return False
+    print("✅ Recycle fires once, after the response is closed")
+
+    # Once recycling, every request is refused and no second signal is sent
+    for path, method in (('/upload', 'post'), ('/debug/memory', 'get')):
+        response = getattr(client, method)(path)
+        response.close()
+        if response.status_code != 503:
+            print(f"❌ {path} not refused while recycling: {response.status_code}")
+            return False
+    if signals != [True] or monitor.active_requests != 0:
+        print("❌ Recycle signal sent more than once")
+        return False
+    print("✅ Requests refused with 503 while recycling")
+
+    # Pending but not yet recycling (a request in flight): only uploads are refused
+    pending = MemoryMonitor(limit_mb=get_rss_bytes() / (1024 * 1024) / 2)
+    pending._send_recycle_signal = lambda: signals.append(True)
+    app = Flask(__name__)
+    pending.init_app(app, debug_endpoint=True)
+    app.add_url_rule('/upload', 'upload_file', lambda: 'ok', methods=['POST'])
+    client = app.test_client()
+    pending.recycle_pending = True
+    pending.request_started()  # a long-running upload still in flight
+    # Test client responses stay in flight until closed, like a real server's
+    with client.post('/upload') as response:
+        if response.status_code != 503:
+            print("❌ Upload accepted while recycle pending")
+            return False
+    with client.get('/debug/memory') as response:
+        if response.status_code != 200:
+            print("❌ Debug endpoint refused from localhost")
+            return False
+    with client.get('/debug/memory', headers={'X-Forwarded-For': '203.0.113.7'}) as proxied:
+        pass
+    if proxied.status_code != 403:
+        print(f"❌ Proxied remote client reached the debug endpoint: {proxied.status_code}")
+        return False
+    if signals != [True]:
+        print("❌ Recycled while a request was still in flight")
+        return False
+    pending.request_finished()
+    if signals != [True, True]:
+        print("❌ Recycle not sent when the last request finished")
+        return False
+    print("✅ Uploads refused while pending; recycle waits for the in-flight request")
+    print("✅ Debug endpoint refuses proxied remote clients")
+
+    return True
+
 def main():
     """Run all tests"""
     print("🧪 Running Qwen Image Editor Tests")
@@ -96,7 +285,9 @@ def main():
     tests = [
         ("Import Tests", test_imports),
         ("App Structure Tests", test_app_structure), 
-        ("Directory Tests", test_directories)
+        ("Directory Tests", test_directories),
+        ("Memory Monitor Tests", test_memory_monitor),
+        ("Memory Request Hook Tests", test_memory_request_hooks)
     ]
     
     all_passed = True